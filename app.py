@@ -1,22 +1,62 @@
-from flask import Flask, render_template, request, send_file, jsonify
+from flask import Flask, Response, render_template, request, send_file, jsonify
 from flask_cors import CORS
-import base64, io, os, time, requests
-from pydub import AudioSegment
-from pydub.effects import normalize
+import atexit, base64, hashlib, hmac, io, itertools, logging, logging.handlers, os, queue, random, re, subprocess, tempfile, threading, time, unicodedata, wave, orjson, requests
 from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import quote
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from key_manager import KeyManager
+from rate_limiter import TokenBucket
 
 # Load .env
 load_dotenv()
 
+# Logging: records go through a queue so the console write happens off the request threads
+log = logging.getLogger("tts")
+try:
+    # Dev server logs every chunk; imported by gunicorn, default to WARNING
+    log.setLevel(os.getenv("LOG_LEVEL", "INFO" if __name__ == "__main__" else "WARNING").upper())
+except ValueError:
+    log.setLevel(logging.INFO)   # unknown LOG_LEVEL value
+_log_queue = queue.SimpleQueue()
+_console = logging.StreamHandler()
+_console.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+log.propagate = False
+_log_listener = logging.handlers.QueueListener(_log_queue, _console)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 app = Flask(__name__, template_folder="templates", static_folder="static")
 CORS(app)
 
 API_BASE = "https://api.sws.speechify.com/v1/audio/speech"
 MAX_CHARS = 2000
-MAX_WORKERS = 5
-SLEEP_PER_CHUNK = 0.3
+SENTENCE_END = re.compile(r"[.!?]\s+|[。！？]\s*")
+SPLIT_LOOKBACK = 400   # how far back from MAX_CHARS to look for a sentence end
+REQUESTS_PER_SEC = 5   # Speechify request rate shared by this process's chunk workers
+REQUEST_BURST = 10
+KEY_WAIT_MAX = 15   # seconds a chunk waits for a benched key before giving up
+POOL_CONNECTIONS = 16
+POOL_MAXSIZE = 32
+MAX_WORKERS = POOL_MAXSIZE   # one worker per pooled connection
+FFMPEG = "ffmpeg"
+PCM_FORMATS = {1: "u8", 2: "s16le", 3: "s24le", 4: "s32le"}   # WAV sample width -> ffmpeg raw format
+JSON_HEADERS = {"Content-Type": "application/json"}
+SSML_TMPL = "<speak>{}</speak>"
+SSML_EMOTION_TMPL = "<speak><emotions value='{}'>{}</emotions></speak>"
+STREAM_BLOCK = 64 * 1024   # MP3 bytes per response write
+BITRATES = {"64k", "128k", "192k", "256k", "320k"}
+
+# Finished MP3s keyed by their inputs; least recently used are swept past CACHE_MAX_FILES
+CACHE_DIR = Path(os.getenv("CACHE_DIR", Path(__file__).resolve().parent / "cache_mp3"))
+CACHE_MAX_FILES = 200
+CACHE_TMP_MAX_AGE = 3600   # seconds before an unfinished .tmp is treated as abandoned
+
+# Shared HTTP session: keep-alive reuses TLS connections across chunks and threads
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=0))
 
 # Admin Password
 KEY_UPLOAD_PASSWORD = os.getenv("ADMIN_PASSWORD", "4444")
@@ -29,58 +69,245 @@ for i in range(1, 101):
         API_KEYS.append(k.strip('"'))
 
 key_manager = KeyManager(limit=50000)
+limiter = TokenBucket(rate=REQUESTS_PER_SEC, capacity=REQUEST_BURST)
 if API_KEYS:
     key_manager.load_keys(API_KEYS)
 else:
-    print("⚠️ No keys found in .env")
+    log.warning("⚠️ No keys found in .env")
+
+
+# ----------------- Text helpers -----------------
+def split_text(text: str, max_chars: int = MAX_CHARS) -> list:
+    """
+    Split text into parts of at most max_chars, cutting after the last
+    sentence end near the limit; hard cut if there is none.
+    """
+    parts = []
+    start = 0
+    while len(text) - start > max_chars:
+        end = start + max_chars
+        cut = end
+        for m in SENTENCE_END.finditer(text, max(start + 1, end - SPLIT_LOOKBACK), end):
+            cut = m.end()
+        parts.append(text[start:cut])
+        start = cut
+    parts.append(text[start:])
+    return parts
+
+
+# ----------------- Audio helpers -----------------
+def read_wav(audio_bytes: bytes):
+    """Split a WAV blob into its params and raw PCM frames."""
+    with wave.open(io.BytesIO(audio_bytes), "rb") as w:
+        return w.getparams(), w.readframes(w.getnframes())
+
+
+def start_mp3_encoder(params, bitrate: str) -> subprocess.Popen:
+    """
+    Spawn one ffmpeg that reads raw PCM on stdin, normalizes, boosts +4dB
+    and writes mono MP3 to stdout.
+    """
+    cmd = [
+        FFMPEG, "-hide_banner", "-loglevel", "error",
+        "-f", PCM_FORMATS[params.sampwidth], "-ar", str(params.framerate), "-ac", str(params.nchannels),
+        "-i", "pipe:0",
+        "-filter:a", "loudnorm,volume=4dB",
+        "-ar", "44100", "-ac", "1", "-b:a", bitrate,   # CD quality sample rate, mono
+        "-f", "mp3", "pipe:1",
+    ]
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def feed_encoder(proc: subprocess.Popen, pcm_chunks, errors: list):
+    """
+    Write PCM chunks to the encoder in order as they arrive, then close its
+    stdin. A chunk that fails to fetch kills the encoder so the partial MP3
+    is not cached; the failure is appended to errors.
+    """
+    try:
+        for frames in pcm_chunks:
+            proc.stdin.write(frames)
+    except (BrokenPipeError, ValueError):
+        pass   # encoder already gone; stream_mp3 reports why
+    except Exception as e:
+        log.error("❌ %s", e)
+        errors.append(str(e))
+        proc.kill()
+    finally:
+        if hasattr(pcm_chunks, "close"):
+            pcm_chunks.close()
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def stream_mp3(proc: subprocess.Popen, head: bytes, errors: list, cache_path: Path = None):
+    """
+    Yield head (the MP3 bytes already read) and then the rest as ffmpeg
+    produces them; kill it if the client leaves. If a chunk or the encode
+    fails mid-stream, raise so the server aborts the response instead of
+    ending it like a complete file. A complete encode is saved to cache_path.
+    """
+    size = 0
+    outcome = "client_left"
+    if cache_path:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix=".tmp", delete=False) if cache_path else None
+    try:
+        blocks = iter(lambda: proc.stdout.read(STREAM_BLOCK), b"")
+        for block in itertools.chain([head], blocks):
+            size += len(block)
+            if tmp:
+                tmp.write(block)
+            yield block
+        proc.wait()
+        if errors or proc.returncode != 0:
+            outcome = "failed"
+            raise RuntimeError(errors[0] if errors else f"ffmpeg exited with code {proc.returncode}")
+        outcome = "ok"
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        err = proc.stderr.read().decode(errors="replace").strip()
+        proc.stdout.close()
+        proc.stderr.close()
+        if outcome == "client_left":
+            log.warning("⚠️ Client left, MP3 encode stopped after %.1f KB", size / 1024)
+        elif outcome == "failed":
+            log.error("❌ MP3 encode failed (code %s): %s", proc.returncode, errors[0] if errors else err)
+        else:
+            log.info("🎧 Final MP3 size=%.1f KB", size / 1024)
+        if tmp:
+            tmp.close()
+            if outcome == "ok":
+                os.replace(tmp.name, cache_path)
+                sweep_cache()
+            else:
+                os.unlink(tmp.name)
+
+
+def content_disposition(file_name: str) -> dict:
+    """
+    Content-Disposition params for an inline MP3: an ASCII filename plus
+    an RFC 5987 filename* when the name is not ASCII (as send_file does).
+    """
+    name = f"{file_name}.mp3"
+    try:
+        name.encode("ascii")
+        return {"filename": name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+        return {"filename": simple, "filename*": f"UTF-8''{quote(name, safe='!#$&+^`|~')}"}
+
+
+# ----------------- MP3 cache -----------------
+def cache_path_for(text: str, voice_id: str, emotion: str, bitrate: str) -> Path:
+    key = hashlib.blake2b("\0".join((text, voice_id, emotion, bitrate)).encode(), digest_size=16).hexdigest()
+    return CACHE_DIR / f"{key}.mp3"
+
+
+def sweep_cache():
+    """
+    Delete the least recently used MP3s beyond CACHE_MAX_FILES, and temp
+    files left behind by encodes that never finished (e.g. a killed worker).
+    """
+    stale = time.time() - CACHE_TMP_MAX_AGE
+    for f in CACHE_DIR.glob("*.tmp"):
+        try:
+            if f.stat().st_mtime < stale:
+                f.unlink()
+        except FileNotFoundError:
+            pass
+
+    files = []
+    for f in CACHE_DIR.glob("*.mp3"):
+        try:
+            files.append((f.stat().st_mtime, f))
+        except FileNotFoundError:
+            pass   # swept concurrently
+    files.sort(reverse=True)
+    for _, f in files[CACHE_MAX_FILES:]:
+        f.unlink(missing_ok=True)
 
 
 # ----------------- Fetch audio one chunk -----------------
-def fetch_chunk_audio(chunk: str, voice_id: str, emotion: str, chunk_index: int) -> AudioSegment:
-    last_error = None
-    for api in list(key_manager.keys):
-        api_key = api["key"]
-
-        for attempt in range(3):
-            try:
-                ssml_extra = f"<emotions value='{emotion}'>" if emotion else ""
-                ssml_text = f"<speak>{ssml_extra}{chunk}{'</emotions>' if emotion else ''}</speak>"
+def fetch_chunk_audio(chunk: str, voice_id: str, emotion: str, chunk_index: int):
+    # Request body is the same for every key and attempt: build it once
+    ssml_text = SSML_EMOTION_TMPL.format(emotion, chunk) if emotion else SSML_TMPL.format(chunk)
+    body = orjson.dumps({"input": ssml_text, "voice_id": voice_id, "audio_format": "wav"})
 
-                payload = {"input": ssml_text, "voice_id": voice_id, "audio_format": "wav"}
-                headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
-
-                r = requests.post(API_BASE, headers=headers, json=payload, timeout=30)
-
-                if r.status_code == 402:
-                    print(f"❌ Key {api_key[:8]} exhausted, skipping")
-                    key_manager.deactivate_key(api_key)
-                    break
-
-                if r.status_code == 503:
-                    wait_time = 2 ** attempt
-                    print(f"⚠️ 503 {api_key[:8]} retry in {wait_time}s (attempt {attempt+1})")
-                    time.sleep(wait_time)
-                    continue
-
-                r.raise_for_status()
-                data = r.json()
-                if "audio_data" not in data or not data["audio_data"]:
-                    raise Exception("No audio_data returned")
+    last_error = None
+    tried = set()
+    for _ in range(key_manager.count()):
+        api_key = key_manager.select_key(len(chunk), exclude=tried, max_wait=KEY_WAIT_MAX)
+        if api_key is None:
+            break
+        tried.add(api_key)
+        status = None
+        ok = False
+        headers = {**JSON_HEADERS, "Authorization": f"Bearer {api_key}"}
+
+        try:
+            for attempt in range(3):
+                try:
+                    limiter.acquire()
+                    r = SESSION.post(API_BASE, headers=headers, data=body, timeout=30)
+                    status = r.status_code
+
+                    if r.status_code == 402:
+                        log.warning("❌ Key %s exhausted, skipping", api_key[:8])
+                        break
+
+                    if r.status_code in (429, 503):
+                        wait_time = 2 ** attempt
+                        log.warning("⚠️ %d %s retry in %ds (attempt %d)", r.status_code, api_key[:8], wait_time, attempt + 1)
+                        time.sleep(wait_time)
+                        continue
+
+                    r.raise_for_status()
+                    data = orjson.loads(r.content)   # parse bytes directly, no str decode
+                    if "audio_data" not in data or not data["audio_data"]:
+                        raise Exception("No audio_data returned")
+
+                    audio_bytes = base64.b64decode(data["audio_data"])
+                    params, frames = read_wav(audio_bytes)
+                    log.info("✅ Chunk %d OK with %s..., len=%.2fs", chunk_index, api_key[:8], params.nframes / params.framerate)
+                    ok = True
+                    return params, frames
+
+                except Exception as e:
+                    last_error = str(e)
+                    log.warning("⚠️ Key %s attempt %d failed: %s", api_key[:8], attempt + 1, last_error)
+                    time.sleep(random.uniform(0.2, 0.8) * 2 ** attempt)   # jittered backoff
+        finally:
+            key_manager.release_key(api_key, ok, status, len(chunk))
+
+        log.warning("➡️ Skipping key %s after repeated failures", api_key[:8])
 
-                audio_bytes = base64.b64decode(data["audio_data"])
-                time.sleep(SLEEP_PER_CHUNK)
-                audio = AudioSegment.from_file(io.BytesIO(audio_bytes), format="wav")
-                print(f"✅ Chunk {chunk_index} OK with {api_key[:8]}..., len={len(audio)/1000:.2f}s")
-                return audio
+    raise Exception(f"All keys failed for chunk {chunk_index}. Last error: {last_error or 'No API responded'}")
 
-            except Exception as e:
-                last_error = str(e)
-                print(f"⚠️ Key {api_key[:8]} attempt {attempt+1} failed: {last_error}")
-                time.sleep(1)
 
-        print(f"➡️ Skipping key {api_key[:8]} after repeated failures")
+def fetch_chunks_in_order(parts: list, voice_id: str, emotion: str):
+    """
+    Fetch all parts concurrently and yield each (params, frames) in text
+    order as soon as it and every part before it have arrived.
+    """
+    if len(parts) == 1:
+        # Short text: fetch inline, no thread pool to spin up
+        yield fetch_chunk_audio(parts[0], voice_id, emotion, 1)
+        return
 
-    raise Exception(f"All keys failed for chunk {chunk_index}. Last error: {last_error or 'No API responded'}")
+    executor = ThreadPoolExecutor(max_workers=min(len(parts), MAX_WORKERS))
+    futures = [executor.submit(fetch_chunk_audio, part, voice_id, emotion, i+1) for i, part in enumerate(parts)]
+    try:
+        for fut in futures:
+            yield fut.result()
+    finally:
+        for fut in futures:
+            fut.cancel()   # request failed or client left: drop chunks not started yet
+        executor.shutdown(wait=False)
 
 
 # ----------------- Routes -----------------
@@ -97,57 +324,88 @@ def speak():
     emotion = request.form.get("emotion", "").strip()
     bitrate = request.form.get("bitrate", "192k")
 
-    if not key_manager.active_keys_left():
-        return jsonify({"status": "error", "message": "❌ No valid keys"}), 403
     if not text:
         return jsonify({"status": "error", "message": "❌ No text"}), 400
+    if bitrate not in BITRATES:
+        return jsonify({"status": "error", "message": "❌ Invalid bitrate"}), 400
 
-    # Split text
-    parts = [text[i:i+MAX_CHARS] for i in range(0, len(text), MAX_CHARS)]
-    final_audio = AudioSegment.silent(duration=0)
+    # Identical request already synthesized: serve it without touching the API
+    cache_path = cache_path_for(text, voice_id, emotion, bitrate)
+    try:
+        os.utime(cache_path)   # bump mtime so the sweeper treats it as recently used
+        log.info("♻️ Cache hit %s", cache_path.name)
+        return send_file(cache_path, mimetype="audio/mpeg", as_attachment=False, download_name=f"{file_name}.mp3")
+    except FileNotFoundError:
+        pass
 
+    if not key_manager.active_keys_left():
+        return jsonify({"status": "error", "message": "❌ No valid keys"}), 403
+
+    # Split text; each part is its own request, fetched concurrently
+    parts = split_text(text)
+
+    # Chunks stream into one ffmpeg pass (normalize, boost, encode) as they arrive,
+    # and the MP3 streams out as it is produced
+    chunks = fetch_chunks_in_order(parts, voice_id, emotion)
     try:
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            results = list(executor.map(
-                lambda tup: fetch_chunk_audio(tup[1], voice_id, emotion, tup[0]+1),
-                enumerate(parts)
-            ))
-            for r in results:
-                final_audio += r
+        params, first = next(chunks)   # failures before any audio still get a JSON error
     except Exception as e:
+        chunks.close()
         return jsonify({"status": "error", "message": str(e)}), 500
+    if not first:
+        chunks.close()
+        return jsonify({"status": "error", "message": "Empty audio"}), 500
+
+    def pcm_frames():
+        try:
+            yield first
+            for chunk_params, frames in chunks:
+                # Raw PCM is piped with the first chunk's format; a different one would play as noise
+                if chunk_params[:3] != params[:3]:
+                    raise ValueError(f"Chunk audio format {tuple(chunk_params[:3])} does not match {tuple(params[:3])}")
+                yield frames
+        finally:
+            chunks.close()
+
+    proc = start_mp3_encoder(params, bitrate)
+    errors = []
+    threading.Thread(target=feed_encoder, args=(proc, pcm_frames(), errors), daemon=True).start()
+
+    # Hold the response until ffmpeg emits audio, so a later chunk failing
+    # before any MP3 exists (loudnorm buffers ~3s) still gets a JSON error
+    head = proc.stdout.read1(STREAM_BLOCK)
+    if not head:
+        proc.wait()
+        err = proc.stderr.read().decode(errors="replace").strip()
+        proc.stdout.close()
+        proc.stderr.close()
+        message = errors[0] if errors else err or "Empty MP3"
+        log.error("❌ MP3 encode failed (code %s): %s", proc.returncode, message)
+        return jsonify({"status": "error", "message": message}), 500
+
+    response = Response(stream_mp3(proc, head, errors, cache_path), mimetype="audio/mpeg")
+    response.headers.set("Content-Disposition", "inline", **content_disposition(file_name))
+    return response
 
-    # 🎚️ Normalize + Boost
-    final_audio = normalize(final_audio)
-    final_audio = final_audio + 4   # Boost by +4dB
-
-    # Export MP3
-    final_audio = final_audio.set_channels(1)
-    buf = io.BytesIO()
-    final_audio.export(buf, format="mp3", bitrate=bitrate, parameters=["-ar","44100"])  # CD quality sample rate
-    buf_size = buf.getbuffer().nbytes
-    print(f"🎧 Final MP3 length = {len(final_audio)/1000:.2f}s, size={buf_size/1024:.1f} KB")
 
-    if buf_size == 0:
-        return jsonify({"status": "error", "message": "Empty MP3"}), 500
-
-    buf.seek(0)
-    return send_file(buf, mimetype="audio/mpeg", as_attachment=False, download_name=f"{file_name}.mp3")
+# -------- Admin Key Management --------
+def check_admin(data: dict) -> bool:
+    """Constant-time compare of the posted password against ADMIN_PASSWORD."""
+    return hmac.compare_digest(str(data.get("password", "")).encode(), KEY_UPLOAD_PASSWORD.encode())
 
 
-# -------- Admin Key Management --------
 @app.route("/check_password", methods=["POST"])
 def check_password():
-    data = request.get_json()
-    if not data or data.get("password") != KEY_UPLOAD_PASSWORD:
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not check_admin(data):
         return jsonify({"status": "error"}), 403
     return jsonify({"status": "ok"})
 
 
 @app.route("/add_key", methods=["POST"])
 def add_key():
-    data = request.get_json()
-    if not data or data.get("password") != KEY_UPLOAD_PASSWORD:
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not check_admin(data):
         return jsonify({"status": "error"}), 403
     new_key = data.get("key", "").strip()
     if new_key:
@@ -158,13 +416,14 @@ def add_key():
 
 @app.route("/delete_key", methods=["POST"])
 def delete_key():
-    data = request.get_json()
-    if not data or data.get("password") != KEY_UPLOAD_PASSWORD:
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not check_admin(data):
         return jsonify({"status": "error"}), 403
     removed = key_manager.delete_first_key()
     return jsonify({"status": "ok", "deleted": bool(removed), "total": key_manager.count()})
 
 
 if __name__ == "__main__":
-    print("🚀 Flask server running at http://127.0.0.1:5000")
+    # Dev server only; production runs under gunicorn -c gunicorn.conf.py app:app
+    log.info("🚀 Flask server running at http://127.0.0.1:5000")
     app.run(debug=True, threaded=True)
\ No newline at end of file
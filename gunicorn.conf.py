@@ -0,0 +1,14 @@
+# Production server: gunicorn -c gunicorn.conf.py app:app
+# gevent makes outbound Speechify calls and ffmpeg pipes cooperative, so one
+# worker serves many /speak requests at once.
+#
+# Keep a single worker: API keys, their usage/cooldown state and the request
+# rate limiter live in process memory, so extra workers would each see their
+# own key list (/add_key, /delete_key, totals) and their own rate budget.
+import os
+
+bind = os.getenv("BIND", f"0.0.0.0:{os.getenv('PORT', '8000')}")
+worker_class = "gevent"
+workers = 1
+worker_connections = 1000
+timeout = 120   # long texts stream for a while
@@ -1,52 +1,109 @@
+import logging, math, threading, time
+
+log = logging.getLogger("tts.keys")
+
+
 class KeyManager:
-    def __init__(self, limit=50000):
+    def __init__(self, limit=50000, cooldown=10):
         """
         Manage multiple Speechify API keys with usage tracking.
+        Each request goes to the healthy key with the fewest in-flight
+        calls and characters used; rate-limited keys sit out a cooldown.
         """
-        self.keys = []   # [{"key": "...", "used": int}]
+        self._keys = []   # [{"key": "...", "used": int, "inflight": int, "disabled_until": float}]
+        self._by_key = {}   # key -> entry, for O(1) lookup
+        self._lock = threading.Lock()
         self.limit = limit
+        self.cooldown = cooldown
 
     def load_keys(self, keys):
         """Load keys fresh"""
-        self.keys = [{"key": k.strip(), "used": 0} for k in keys if k and k.strip()]
-        print(f"✅ Loaded {len(self.keys)} keys")
+        with self._lock:
+            self._keys.clear()
+            self._by_key.clear()
+            for k in keys:
+                if k and k.strip():
+                    self._push(k.strip())
+        log.info("✅ Loaded %d keys", len(self._keys))
 
     def add_key(self, key):
         """Add a new key"""
         if key and key.strip():
-            self.keys.append({"key": key.strip(), "used": 0})
-            print(f"➕ Added key {key[:8]}..., total = {len(self.keys)}")
+            with self._lock:
+                self._push(key.strip())
+            log.info("➕ Added key %s..., total = %d", key[:8], len(self._keys))
+
+    def _push(self, key):
+        if key in self._by_key:
+            return
+        entry = {"key": key, "used": 0, "inflight": 0, "disabled_until": 0.0}
+        self._keys.append(entry)
+        self._by_key[key] = entry
+
+    def select_key(self, chars_needed=0, exclude=(), max_wait=0):
+        """
+        Pick the least loaded key that is not cooling down and can still
+        afford chars_needed. Charges it and marks a call in flight; pair
+        every successful pick with release_key().
+        If every such key is cooling down, wait up to max_wait seconds for
+        the first one to come back.
+        """
+        deadline = time.time() + max_wait
+        while True:
+            now = time.time()
+            with self._lock:
+                eligible = [
+                    api for api in self._keys
+                    if api["used"] + chars_needed <= self.limit
+                    and api["key"] not in exclude
+                ]
+                candidates = [api for api in eligible if api["disabled_until"] < now]
+                if candidates:
+                    api = min(candidates, key=lambda a: (a["inflight"], a["used"]))
+                    api["used"] += chars_needed
+                    api["inflight"] += 1
+                    return api["key"]
+                ready_at = min((api["disabled_until"] for api in eligible), default=math.inf)
+            if ready_at > deadline:
+                return None
+            time.sleep(max(ready_at - now, 0))
 
-    def get_available_key(self, chars_needed):
+    def release_key(self, key, ok, status=None, chars=0):
         """
-        Return the first available key that can handle this request.
+        Finish a call made with key. A failed call refunds the chars it was
+        charged; 402 disables the key for good, 429/503 bench it for the
+        cooldown period.
         """
-        for api in self.keys:
-            if api["used"] + chars_needed <= self.limit:
-                api["used"] += chars_needed
-                return api["key"]
-        return None
-
-    def deactivate_key(self, bad_key: str):
-        """Remove a specific key from the pool"""
-        for i, api in enumerate(self.keys):
-            if api["key"] == bad_key:
-                removed = self.keys.pop(i)
-                print(f"❌ Deactivated key {removed['key'][:8]}..., {len(self.keys)} left")
-                return removed
-        return None
+        with self._lock:
+            api = self._by_key.get(key)
+            if api is None:
+                return
+            api["inflight"] = max(api["inflight"] - 1, 0)
+            if not ok:
+                api["used"] = max(api["used"] - chars, 0)
+            if status == 402:
+                api["disabled_until"] = math.inf
+            elif status in (429, 503):
+                api["disabled_until"] = time.time() + self.cooldown
 
     def delete_first_key(self):
         """Remove the first key (legacy method)"""
-        if self.keys:
-            removed = self.keys.pop(0)
-            print(f"❌ Deleted key {removed['key'][:8]}..., {len(self.keys)} left")
-            return removed
-        return None
+        with self._lock:
+            if not self._keys:
+                return None
+            removed = self._keys.pop(0)
+            self._by_key.pop(removed["key"], None)
+        log.info("❌ Deleted key %s..., %d left", removed["key"][:8], len(self._keys))
+        return removed
 
     def active_keys_left(self):
         """Are there any usable keys left?"""
-        return any(api["used"] < self.limit for api in self.keys)
+        with self._lock:
+            return any(
+                api["used"] < self.limit and api["disabled_until"] != math.inf
+                for api in self._keys
+            )
 
     def count(self):
-        return len(self.keys)
\ No newline at end of file
+        with self._lock:
+            return len(self._keys)
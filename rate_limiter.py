@@ -0,0 +1,25 @@
+import threading, time
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        """
+        Shared request throttle: refills `rate` tokens per second up to
+        `capacity`, so short bursts go out immediately.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, sleeping only as long as this caller's turn needs"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1   # reserve our token, even if it goes negative
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)